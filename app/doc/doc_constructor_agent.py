@@ -1,28 +1,148 @@
+import io
 import os
 import re
+import docx
 from docx import Document
+from docx.oxml import OxmlElement, parse_xml
+from docx.oxml.ns import qn
 from docx.shared import Inches
+from lxml import etree
+
+# python-docx's bundled default template, read once so every document build
+# starts from an in-memory copy instead of reopening it from disk
+with open(os.path.join(os.path.dirname(docx.__file__), "templates", "default.docx"), "rb") as _f:
+    _TEMPLATE_BYTES = _f.read()
+
+# Style id of "Light List" in the default python-docx template
+TABLE_STYLE_ID = "LightList"
+
+_DIVIDER_CHARS = frozenset('-:|')
+_GH_DIVIDER_CHARS = frozenset('-|')
+_GH_DIVIDER_RE = re.compile(r'^-+(\s*\|\s*-+)+$')
+# Disjoint leading characters keep this to one pass per line:
+# md = |a|b| header, gh = ---|--- divider
+_TABLE_DIALECT_RE = re.compile(r'(?P<md>\|(?:.*\|)?)|(?P<gh>-+(?:\s*\|\s*-+)+)')
+_MULTI_SPACE_RE = re.compile(r'  +')
+_RUN_SPECIAL_RE = re.compile(r'([\t\r\n])')
+# Lines starting with these (case-insensitive) are labels, not the flow itself
+_FLOW_SKIP_PREFIXES = ('diagram', 'flow', 'legend', '#')
+
+def _table_dialect(line):
+    """Returns 'md' or 'gh' for a stripped table line, or None."""
+    m = _TABLE_DIALECT_RE.fullmatch(line)
+    return m.lastgroup if m else None
+
+def _split_pipe_rows(lines):
+    return [[c.strip() for c in l.split('|')] for l in lines]
+
+def _only_divider_chars(line, allowed):
+    r"""
+    True if line uses only the allowed characters plus whitespace. Any
+    character str.isspace() accepts counts, which is exactly what \s accepts.
+    """
+    extra = set(line).difference(allowed)
+    return not extra or ''.join(extra).isspace()
+
+def _is_github_divider(line):
+    # Cheap character-set check first; the regex only confirms the shape
+    return (line.startswith('-') and _only_divider_chars(line, _GH_DIVIDER_CHARS)
+            and _GH_DIVIDER_RE.match(line) is not None)
+
+def _new_run(text):
+    # Same translation as python-docx's run.text setter: tab -> <w:tab/>,
+    # CR/LF -> <w:br/>, everything else into <w:t>.
+    # Text is assigned to each <w:t> exactly once and left as str; lxml
+    # encodes it a single time when the document is saved.
+    r = OxmlElement('w:r')
+    pieces = _RUN_SPECIAL_RE.split(text) if _RUN_SPECIAL_RE.search(text) else (text,)
+    for piece in pieces:
+        if piece == '\t':
+            r.append(OxmlElement('w:tab'))
+        elif piece in ('\r', '\n'):
+            r.append(OxmlElement('w:br'))
+        elif piece:
+            t = OxmlElement('w:t')
+            t.text = piece
+            if piece[0].isspace() or piece[-1].isspace():
+                t.set(qn('xml:space'), 'preserve')
+            r.append(t)
+    return r
+
+def _append_body_element(body, element):
+    """Appends a block element to the document body, keeping <w:sectPr> last."""
+    last = body[-1] if len(body) else None
+    if last is not None and last.tag == qn('w:sectPr'):
+        last.addprevious(element)
+    else:
+        body.append(element)
+
+def _append_paragraph(body, text, style_id=None):
+    """Appends a <w:p> with a single run to the document body."""
+    p = OxmlElement('w:p')
+    if style_id:
+        pPr = OxmlElement('w:pPr')
+        pStyle = OxmlElement('w:pStyle')
+        pStyle.set(qn('w:val'), style_id)
+        pPr.append(pStyle)
+        p.append(pPr)
+    if text:
+        p.append(_new_run(text))
+    _append_body_element(body, p)
+    return p
 
 def add_heading(doc, text, level):
-    doc.add_heading(text, level=level)
+    _append_paragraph(doc.element.body, text, "Title" if level == 0 else f"Heading{level}")
+
+def _new_table_row(values, widths):
+    tr = OxmlElement('w:tr')
+    for val, width in zip(values, widths):
+        tc = OxmlElement('w:tc')
+        tcPr = OxmlElement('w:tcPr')
+        tcW = OxmlElement('w:tcW')
+        tcW.set(qn('w:type'), 'dxa')
+        tcW.set(qn('w:w'), width)
+        tcPr.append(tcW)
+        tc.append(tcPr)
+        p = OxmlElement('w:p')
+        # Like cell.text = "", an empty value still gets an empty <w:r/>;
+        # None marks padding for a short row and leaves the paragraph bare.
+        if val is not None:
+            p.append(_new_run(val))
+        tc.append(p)
+        tr.append(tc)
+    return tr
 
 def add_table(doc, colnames, rows):
-    table = doc.add_table(rows=1, cols=len(colnames))
-    table.style = "Light List"
-    hdr_cells = table.rows[0].cells
-    for i, col in enumerate(colnames):
-        hdr_cells[i].text = str(col)
-    for row_data in rows:
-        row_cells = table.add_row().cells
-        for i, val in enumerate(row_data):
-            row_cells[i].text = str(val) if val is not None else ""
+    # Rows are built as raw <w:tr> elements; going through table.add_row() and
+    # cell.text re-walks the table XML on every call.
+    table = doc.add_table(rows=0, cols=len(colnames))
+    tbl = table._tbl
+    tblStyle = OxmlElement('w:tblStyle')
+    tblStyle.set(qn('w:val'), TABLE_STYLE_ID)
+    tbl.tblPr.insert(0, tblStyle)
+    widths = [gridCol.get(qn('w:w')) for gridCol in tbl.tblGrid.iterchildren(qn('w:gridCol'))]
+    # Cells parsed from LLM output are already str; skip the no-op str() call
+    stringified = [[v if type(v) is str else ("" if v is None else str(v)) for v in row] for row in rows]
+    _append = tbl.append
+    _append(_new_table_row([str(col) for col in colnames], widths))
+    for row_data in stringified:
+        if len(row_data) > len(widths):
+            # Same failure as indexing past table.add_row().cells used to give
+            raise IndexError(f"table row has {len(row_data)} cells but only {len(widths)} columns")
+        if len(row_data) < len(widths):
+            row_data += [None] * (len(widths) - len(row_data))
+        _append(_new_table_row(row_data, widths))
     return table
 
-def find_section_content(content_list, section_title):
+def index_section_content(content_list):
+    """Maps normalized section_name -> content; the first entry for a name wins."""
+    content_index = {}
     for sec in content_list:
-        if sec.get('section_name', '').lower().strip() == section_title.lower().strip():
-            return sec['content']
-    return None
+        content_index.setdefault(sec.get('section_name', '').lower().strip(), sec.get('content'))
+    return content_index
+
+def find_section_content(content_list, section_title):
+    return index_section_content(content_list).get(section_title.lower().strip())
 
 def find_all_table_like_chunks(text):
     """
@@ -32,69 +152,59 @@ def find_all_table_like_chunks(text):
     if not text or not text.strip():
         return []
     lines = text.splitlines()
+    n = len(lines)
     chunks = []
-    buf = []
-    in_table = False
-
-    def flush(par, typ):
-        s = "\n".join(par).strip()
-        if s:
-            chunks.append((typ, s))
-
     i = 0
-    while i < len(lines):
+    while i < n:
         l = lines[i]
-        if l.count('|') >= 1 and l.strip() and (i+1<len(lines) and lines[i+1].count('|')>=1):
+        # A line with a pipe is never blank, so '|' in l covers both checks
+        if '|' in l and i + 1 < n and '|' in lines[i + 1]:
             # Start of table block
-            buf = [l]
-            i += 1
-            while i < len(lines) and lines[i].count('|') >= 1 and lines[i].strip():
-                buf.append(lines[i])
-                i += 1
-            flush(buf, "table")
-            buf = []
+            j = i + 2
+            while j < n and '|' in lines[j]:
+                j += 1
+            chunks.append(("table", "\n".join(lines[i:j]).strip()))
+            i = j
         else:
-            if l.strip():
-                flush([l], "text")
+            s = l.strip()
+            if s:
+                chunks.append(("text", s))
             i += 1
     return chunks
 
-def parse_markdown_table(table_md):
-    lines = [l.strip() for l in table_md.strip().splitlines() if l.strip()]
+def _table_lines(raw_lines):
+    return [l.strip() for l in raw_lines if l.strip()]
+
+def _parse_markdown_lines(lines):
     if len(lines) < 2: return None, None
     # Classic markdown: at least header and |---|
     if not (lines[0].startswith('|') and lines[0].endswith('|')):
         return None, None
-    rows = [[cell.strip() for cell in l.strip('|').split('|')] for l in lines]
-    if len(rows) < 2: return None, None
+    rows = _split_pipe_rows(l.strip('|') for l in lines)
     # Remove divider if present
-    if re.match(r'^[-:\s|]+$', ''.join(lines[1])):
+    if _only_divider_chars(lines[1], _DIVIDER_CHARS):
         del rows[1]
     colnames, data_rows = rows[0], rows[1:]
     if all(len(r) == len(colnames) for r in data_rows):
         return colnames, data_rows
     return None, None
 
-def parse_github_style_table(table_md):
-    lines = [l.strip() for l in table_md.strip().splitlines() if l.strip()]
+def _parse_github_style_lines(lines):
     if len(lines) < 2: return None, None
     # 2nd line looks like github divider (---|---)
-    if not re.match(r'^-+(\s*\|\s*-+)+$', lines[1]):
+    if not _is_github_divider(lines[1]):
         return None, None
-    colnames = [c.strip() for c in lines[0].split('|')]
-    data_rows = [[c.strip() for c in l.split('|')] for l in lines[2:] if '|' in l]
+    colnames = _split_pipe_rows(lines[:1])[0]
+    data_rows = _split_pipe_rows(l for l in lines[2:] if '|' in l)
     if all(len(r) == len(colnames) for r in data_rows):
         return colnames, data_rows
     return None, None
 
-def parse_simple_pipe_table(table_md):
-    """
-    Fallback: Any rows with consistent number of pipes.
-    """
+def _parse_simple_pipe_lines(raw_lines):
     # Only rows that have | and not divider
-    lines = [l.strip() for l in table_md.strip().splitlines() if '|' in l and not re.match(r'^-+(\s*\|\s*-+)+$', l)]
+    lines = [l.strip() for l in raw_lines if '|' in l and not _is_github_divider(l)]
     if len(lines) < 2: return None, None
-    rows = [[c.strip() for c in l.split('|')] for l in lines]
+    rows = _split_pipe_rows(lines)
     ncols = len(rows[0])
     if all(len(row) == ncols for row in rows):
         colnames = rows[0]
@@ -102,17 +212,13 @@ def parse_simple_pipe_table(table_md):
         return colnames, data_rows
     return None, None
 
-def parse_any_delim_table(table_md):
-    """
-    Ultra-forgiving: Split on the *most common* delimiter if all rows same length.
-    """
-    lines = [l.strip() for l in table_md.strip().splitlines() if l.strip()]
+def _parse_any_delim_lines(lines):
     if len(lines) < 2: return None, None
     delimiters = ['|', '\t', '  +']  # pipe, tab, multi-space
     for delim in delimiters:
         try:
             if delim == '  +':
-                rows = [re.split(r'  +', l) for l in lines]
+                rows = [_MULTI_SPACE_RE.split(l) for l in lines]
             else:
                 rows = [l.split(delim) for l in lines]
             ncols = len(rows[0])
@@ -122,19 +228,132 @@ def parse_any_delim_table(table_md):
             continue
     return None, None
 
+def parse_markdown_table(table_md):
+    return _parse_markdown_lines(_table_lines(table_md.strip().splitlines()))
+
+def parse_github_style_table(table_md):
+    return _parse_github_style_lines(_table_lines(table_md.strip().splitlines()))
+
+def parse_simple_pipe_table(table_md):
+    """
+    Fallback: Any rows with consistent number of pipes.
+    """
+    return _parse_simple_pipe_lines(table_md.strip().splitlines())
+
+def parse_any_delim_table(table_md):
+    """
+    Ultra-forgiving: Split on the *most common* delimiter if all rows same length.
+    """
+    return _parse_any_delim_lines(_table_lines(table_md.strip().splitlines()))
+
+def parse_table(table_md):
+    """
+    Splits the block into lines once, checks the first line for a markdown
+    header and the second for a GitHub divider with _TABLE_DIALECT_RE, and
+    only runs the parsers that can match, falling back to the any-delimiter
+    parser.
+    """
+    raw_lines = table_md.strip().splitlines()
+    lines = _table_lines(raw_lines)
+    if len(lines) < 2:
+        return None, None
+    first_dialect = _table_dialect(lines[0])
+    second_dialect = _table_dialect(lines[1])
+    attempts = []
+    if first_dialect == 'md':
+        attempts.append((_parse_markdown_lines, lines))
+    if second_dialect == 'gh':
+        attempts.append((_parse_github_style_lines, lines))
+    if '|' in table_md:
+        attempts.append((_parse_simple_pipe_lines, raw_lines))
+    attempts.append((_parse_any_delim_lines, lines))
+    for parser, parser_lines in attempts:
+        colnames, rows = parser(parser_lines)
+        if colnames and rows:
+            return colnames, rows
+    return None, None
+
+def _has_other_line_break(text):
+    r"""True if text has a line boundary splitlines() knows other than '\n'."""
+    # Single-character 'in' checks are C-speed scans, and isascii() is O(1),
+    # so the non-ASCII separators are only looked for when they can occur
+    if ('\r' in text or '\v' in text or '\f' in text
+            or '\x1c' in text or '\x1d' in text or '\x1e' in text):
+        return True
+    return not text.isascii() and ('\x85' in text or '\u2028' in text or '\u2029' in text)
+
 def extract_arrow_flow(text):
     if not text:
         return ""
-    for line in text.splitlines():
-        line = line.strip("` ").strip()
-        if "->" in line and not line.lower().startswith(('diagram', 'flow', 'legend', '#')):
+    idx = text.find("->")
+    if idx == -1:
+        return ""
+    # Jump straight to each '->' and check only the line it sits on, rather
+    # than splitting the whole text into lines. Text using any other line
+    # boundary splitlines() knows (CR, CRLF, \v, \u2028, ...) is folded to
+    # '\n' first so the lines are the same ones the old loop saw.
+    flat = text
+    if _has_other_line_break(flat):
+        flat = "\n".join(flat.splitlines())
+        idx = flat.find("->")
+    while idx != -1:
+        start = flat.rfind("\n", 0, idx) + 1
+        end = flat.find("\n", idx)
+        if end == -1:
+            end = len(flat)
+        line = flat[start:end].strip("` ").strip()
+        # The skip prefixes are short, so only the head of the line is lowercased
+        if not line[:16].lower().startswith(_FLOW_SKIP_PREFIXES):
             return line
-    if "->" in text:
-        return text.strip()
-    return ""
+        idx = flat.find("->", end)
+    return text.strip()
 
-def build_document(content, sections, flow_diagram_agent=None, diagram_dir="diagrams"):
-    doc = Document()
+def render_section_content(doc, sec_content):
+    """Appends the paragraphs and tables for one section's text to doc."""
+    body = doc.element.body
+    # Universal parsing for text+tables:
+    chunks = find_all_table_like_chunks(sec_content or "")
+    for typ, value in chunks:
+        if typ == 'text':
+            _append_paragraph(body, value)
+        elif typ == 'table':
+            colnames, rows = parse_table(value)
+            if colnames and rows:
+                add_table(doc, colnames, rows)
+            else:
+                _append_paragraph(body, value)
+
+def _render_section_fragments(sec_content):
+    """
+    Process-pool worker: renders one section into a scratch document built
+    from the same template and returns its body elements as XML bytes.
+    """
+    doc = Document(io.BytesIO(_TEMPLATE_BYTES))
+    render_section_content(doc, sec_content)
+    sectPr_tag = qn('w:sectPr')
+    return [etree.tostring(el) for el in doc.element.body if el.tag != sectPr_tag]
+
+def build_document(content, sections, flow_diagram_agent=None, diagram_dir="diagrams", executor=None):
+    """
+    Builds the spec document. If executor (e.g. a ProcessPoolExecutor) is
+    given, section bodies are rendered through executor.map and spliced back
+    in section order; headings and flow diagrams are always added in this
+    process.
+
+    The executor is owned by the caller and should be created once and
+    reused: starting a pool costs more than rendering a typical spec. When
+    calling from threads (FastAPI background tasks run in a thread pool),
+    create it with a "spawn" or "forkserver" mp_context rather than
+    forking a multi-threaded process.
+    """
+    doc = Document(io.BytesIO(_TEMPLATE_BYTES))
+    body = doc.element.body
+    content_index = index_section_content(content)
+
+    title_keys = [section.get("title").lower().strip() for section in sections]
+    rendered = None
+    if executor is not None:
+        rendered = list(executor.map(_render_section_fragments, [content_index.get(k) for k in title_keys]))
 
     # Add main heading
     add_heading(doc, "Technical Specification Document", 0)
@@ -144,10 +363,11 @@ def build_document(content, sections, flow_diagram_agent=None, diagram_dir="diag
         header = f"{i+1}. {title}"
         add_heading(doc, header, 1)
 
-        sec_content = find_section_content(content, title)
+        title_key = title_keys[i]
+        sec_content = content_index.get(title_key)
 
         # FLOW DIAGRAM SECTION HANDLING
-        if title.strip().lower() == "flow diagram":
+        if title_key == "flow diagram":
             diagram_img = None
             if flow_diagram_agent is not None and sec_content:
                 try:
@@ -162,26 +382,14 @@ def build_document(content, sections, flow_diagram_agent=None, diagram_dir="diag
             if diagram_img:
                 doc.add_picture(diagram_img, width=Inches(5.5))
             else:
-                doc.add_paragraph("[Flow diagram not available]")
+                _append_paragraph(body, "[Flow diagram not available]")
                 continue  # Skip remaining processing for this section
 
-        # Universal parsing for text+tables:
-        chunks = find_all_table_like_chunks(sec_content or "")
-        for typ, value in chunks:
-            if typ == 'text':
-                doc.add_paragraph(value)
-            elif typ == 'table':
-                colnames, rows = parse_markdown_table(value)
-                if not (colnames and rows):
-                    colnames, rows = parse_github_style_table(value)
-                if not (colnames and rows):
-                    colnames, rows = parse_simple_pipe_table(value)
-                if not (colnames and rows):
-                    colnames, rows = parse_any_delim_table(value)
-                if colnames and rows:
-                    add_table(doc, colnames, rows)
-                else:
-                    doc.add_paragraph(value)
-
-    doc.add_paragraph("\nDocument generated by PWC AI-powered ABAP Tech Spec Assistant.")
-    return doc
\ No newline at end of file
+        if rendered is None:
+            render_section_content(doc, sec_content)
+        else:
+            for fragment in rendered[i]:
+                _append_body_element(body, parse_xml(fragment))
+
+    _append_paragraph(body, "\nDocument generated by PWC AI-powered ABAP Tech Spec Assistant.")
+    return doc
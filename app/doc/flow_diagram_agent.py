@@ -4,16 +4,7 @@ import re
 import matplotlib.pyplot as plt
 import matplotlib.patches as mpatches
 
-def extract_arrow_flow(text):
-    if not text:
-        return ""
-    for line in text.splitlines():
-        stripped = line.strip("` ").strip()
-        if "->" in stripped and not stripped.lower().startswith(('diagram', 'flow', 'legend', '#')):
-            return stripped
-    if "->" in text:
-        return text.strip()
-    return ""
+from app.doc.doc_constructor_agent import extract_arrow_flow
 
 def parse_flow_string(flow_str):
     if not flow_str: